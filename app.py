@@ -1,7 +1,10 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
+import pyarrow as pa
 import re
+import csv
+import codecs
 import unicodedata
 from io import BytesIO
 
@@ -36,109 +39,210 @@ TARGET_COLUMNS = [
     'bairro', 'cidade', 'uf', 'observacoes'
 ]
 
+# Strings em buffers contíguos do Arrow em vez de um objeto Python por célula
+STRING_DTYPE = "string[pyarrow]"
+
+# Uma alternância compilada por campo: cada cabeçalho é varrido uma vez por campo
+_COLUMN_PATTERNS = {
+    target_col: re.compile('|'.join(re.escape(name.lower()) for name in possible_names))
+    for target_col, possible_names in COLUMN_MAPPINGS.items()
+}
+_ANY_COLUMN_PATTERN = re.compile('|'.join(pattern.pattern for pattern in _COLUMN_PATTERNS.values()))
+
+# Sinônimos de sobrenome contêm sinônimos de outros campos ('nome' em 'sobrenome',
+# 'último nome', 'sobre nome'); para esses campos, esses trechos do cabeçalho não contam
+_SURNAME_PATTERN = re.compile('|'.join(
+    re.escape(name.lower()) for name in sorted(COLUMN_MAPPINGS['sobrenome'], key=len, reverse=True)
+))
+_SURNAME_SENSITIVE = {
+    target_col for target_col, possible_names in COLUMN_MAPPINGS.items()
+    if target_col != 'sobrenome' and any(
+        name.lower() in surname.lower()
+        for name in possible_names for surname in COLUMN_MAPPINGS['sobrenome']
+    )
+}
+
+_EMPTY_MARKERS = ["nan", "none", "na", "n/a", ""]
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
 # ========== FUNCTIONS ==========
 def strip_accents(s: str) -> str:
     if not isinstance(s, str):
         s = str(s) if s is not None else ""
+    if s.isascii():
+        return s
     return ''.join(c for c in unicodedata.normalize('NFKD', s) if not unicodedata.combining(c))
 
 def norm_text(s: str) -> str:
     s = strip_accents(s).lower()
-    return re.sub(r'\s+', ' ', s).strip()
+    return _WHITESPACE_RE.sub(' ', s).strip()
 
 def clean_str_series(ser: pd.Series) -> pd.Series:
-    ser = ser.astype(str).replace({np.nan: ""})
-    ser = ser.map(lambda x: "" if norm_text(x) in {"nan", "none", "na", "n/a", ""} else x.strip())
-    return ser
-
-def clean_document(doc):
-    if pd.isna(doc) or str(doc).strip() == "":
-        return "", ""
-    doc_clean = re.sub(r"\D", "", str(doc))
-    if len(doc_clean) == 11:
-        return doc_clean, "F"
-    elif len(doc_clean) == 14:
-        return doc_clean, "J"
-    return doc_clean, ""
-
-def read_uploaded_file(file):
+    ser = ser.astype(STRING_DTYPE).fillna("").str.strip()
+    return ser.mask(ser.str.lower().isin(_EMPTY_MARKERS), "")
+
+def clean_documents(ser: pd.Series) -> tuple[pd.Series, pd.Series]:
+    docs = ser.astype(STRING_DTYPE).str.replace(r"\D", "", regex=True)
+    lens = docs.str.len().to_numpy()
+    tipo = np.where(lens == 11, "F", np.where(lens == 14, "J", ""))
+    return docs, pd.Series(tipo, index=docs.index, dtype=STRING_DTYPE)
+
+def sniff_csv(data: bytes, sample_size: int = 65536) -> tuple[str, str]:
+    sample = data[:sample_size]
+    try:
+        # Decoder incremental tolera um caractere multibyte cortado no fim da amostra
+        encoding = 'utf-8'
+        text = codecs.getincrementaldecoder(encoding)().decode(sample)
+    except UnicodeDecodeError:
+        encoding = 'latin1'
+        text = sample.decode(encoding)
+    if len(data) > sample_size and '\n' in text:
+        text = text[:text.rindex('\n')]
+    try:
+        sep = csv.Sniffer().sniff(text, delimiters=',;\t|').delimiter
+    except csv.Error:
+        # Linhas com quantidades diferentes de campos confundem o Sniffer;
+        # tenta só o cabeçalho, como faz o motor python do pandas
+        header = text.partition('\n')[0]
+        try:
+            sep = csv.Sniffer().sniff(header, delimiters=',;\t|').delimiter
+        except csv.Error:
+            if any(delim in header for delim in ',;\t|'):
+                raise ValueError("Não foi possível identificar o separador do arquivo CSV")
+            # Sem delimitador nenhum (ex.: arquivo de uma coluna só)
+            sep = ','
+    return encoding, sep
+
+def is_mapped_column(src_col) -> bool:
+    # Usado como usecols: colunas sem correspondência nem chegam a ser convertidas
+    return _ANY_COLUMN_PATTERN.search(norm_text(str(src_col))) is not None
+
+def read_uploaded_file(name: str, data: bytes) -> pd.DataFrame:
     try:
-        if file.name.lower().endswith('.csv'):
-            for encoding in ['utf-8', 'latin1', 'iso-8859-1', 'windows-1252']:
+        if name.lower().endswith('.csv'):
+            encoding, sep = sniff_csv(data)
+            # A amostra pode ser UTF-8 válido e o resto do arquivo não; latin1 sempre decodifica
+            for encoding in (encoding, 'latin1'):
                 try:
-                    return pd.read_csv(file, encoding=encoding, sep=None, engine='python', on_bad_lines='warn')
-                except (UnicodeDecodeError, pd.errors.ParserError):
-                    file.seek(0)
+                    return pd.read_csv(BytesIO(data), encoding=encoding, sep=sep, engine='c', on_bad_lines='warn', usecols=is_mapped_column, dtype_backend='pyarrow')
+                except UnicodeDecodeError:
                     continue
             raise ValueError("Não foi possível determinar a codificação do arquivo CSV")
         else:
-            return pd.read_excel(file, dtype=object)
+            # calamine lê tanto .xlsx quanto .xls, sem depender do xlrd
+            try:
+                return pd.read_excel(BytesIO(data), dtype=object, engine='calamine', usecols=is_mapped_column)
+            except ImportError:
+                return pd.read_excel(BytesIO(data), dtype=object, usecols=is_mapped_column)
     except Exception as e:
-        st.error(f"ERRO NA LEITURA: {str(e)}")
-        return None
+        raise ValueError(f"ERRO NA LEITURA: {str(e)}") from e
 
 def map_source_columns(df):
+    # Normaliza os cabeçalhos uma única vez; a ordem das colunas define a prioridade
+    normalized_cols = [(src_col, norm_text(str(src_col))) for src_col in df.columns]
+    without_surname = [(src_col, _SURNAME_PATTERN.sub(' ', normalized)) for src_col, normalized in normalized_cols]
     mapped = {}
-    for target_col, possible_names in COLUMN_MAPPINGS.items():
-        for src_col in df.columns:
-            if any(name.lower() in norm_text(str(src_col)) for name in possible_names):
-                mapped[target_col] = clean_str_series(df[src_col])
+    for target_col, pattern in _COLUMN_PATTERNS.items():
+        candidates = without_surname if target_col in _SURNAME_SENSITIVE else normalized_cols
+        for src_col, normalized in candidates:
+            if pattern.search(normalized):
+                mapped[target_col] = df[src_col]
                 break
-        else:
-            mapped[target_col] = pd.Series([""] * len(df), dtype=str)
     return mapped
 
-def process_data(file):
-    if file is None:
-        return None
+@st.cache_data(show_spinner=False, max_entries=4)
+def _process_bytes(name: str, data: bytes) -> pd.DataFrame:
+    df = read_uploaded_file(name, data)
+    if df.columns.empty:
+        raise ValueError("Nenhuma coluna de documento (CPF/CNPJ) encontrada")
+    if df.empty:
+        raise ValueError("Arquivo vazio ou inválido")
+    
+    source_cols = map_source_columns(df)
     
-    with st.spinner("Lendo arquivo..."):
-        df = read_uploaded_file(file)
-        if df is None or df.empty:
-            st.error("Arquivo vazio ou inválido")
-            return None
+    if 'cpf' not in source_cols:
+        raise ValueError("Nenhuma coluna de documento (CPF/CNPJ) encontrada")
+    cpf = clean_str_series(source_cols.pop('cpf'))
+    if cpf.eq("").all():
+        raise ValueError("Nenhuma coluna de documento (CPF/CNPJ) encontrada")
     
-    with st.spinner("Mapeando colunas..."):
-        mapped_data = map_source_columns(df)
+    try:
+        cpf, tipo_pessoa = clean_documents(cpf)
+        
+        # Remove os duplicados antes de limpar as demais colunas, que só são
+        # processadas para as linhas que vão para a saída
+        keep = ~cpf.duplicated(keep='first')
+        mapped_data = {target_col: clean_str_series(ser[keep]) for target_col, ser in source_cols.items()}
+        mapped_data['cpf'] = cpf[keep]
+        mapped_data['tipo_pessoa'] = tipo_pessoa[keep]
+        
+        # Uma única coluna vazia compartilhada por todos os campos não encontrados
+        index = mapped_data['cpf'].index
+        empty = pd.Series(pd.array(pa.repeat("", len(index)), dtype=STRING_DTYPE), index=index)
+        
+        # Monta razao_social
+        rs = mapped_data.get('razao_social', empty)
+        sn = mapped_data.get('sobrenome', empty)
+        pn = mapped_data.get('primeiro_nome', empty)
+        
+        # As partes já vêm sem espaços nas pontas (clean_str_series), então
+        # só a junção de primeiro nome e sobrenome precisa de strip.
+        # Busca literal por espaço primeiro; o regex \s só roda nas linhas restantes
+        need_concat = (rs != "") & (sn != "") & ~rs.str.contains(" ", regex=False)
+        if need_concat.any():
+            need_concat[need_concat] = ~rs[need_concat].str.contains(r"\s", regex=True)
+        rs = rs.mask(need_concat, rs + " " + sn)
+        rs = rs.mask(rs == "", (pn + " " + sn).str.strip())
+        rs = rs.mask(rs == "", "NÃO INFORMADO")
+        
+        mapped_data['razao_social'] = rs
+        
+        if 'uf' in mapped_data:
+            # Já vem sem espaços (clean_str_series); corta antes de converter para maiúsculas
+            mapped_data['uf'] = mapped_data['uf'].str[:2].str.upper()
+        
+        # Monta a saída direto dos arrays (já em STRING_DTYPE), sem alinhar índices nem copiar
+        output_df = pd.DataFrame({
+            col: mapped_data.get(col, empty).array
+            for col in TARGET_COLUMNS
+        }, copy=False)
         
-        if 'cpf' not in mapped_data or mapped_data['cpf'].eq("").all():
-            st.error("Nenhuma coluna de documento (CPF/CNPJ) encontrada")
-            return None
+        return output_df
+        
+    except Exception as e:
+        raise ValueError(f"ERRO NO PROCESSAMENTO: {str(e)}") from e
+
+def process_data(file):
+    if file is None:
+        return None
     
-    with st.spinner("Processando dados..."):
-        try:
-            documents = mapped_data['cpf'].apply(clean_document)
-            mapped_data['cpf'], mapped_data['tipo_pessoa'] = zip(*documents)
-            
-            # Monta razao_social
-            rs = mapped_data['razao_social']
-            sn = mapped_data['sobrenome']
-            pn = mapped_data['primeiro_nome']
-            
-            rs_has_space = rs.str.contains(r"\s", regex=True)
-            need_concat = (~rs_has_space) & (rs != "") & (sn != "")
-            rs = rs.where(~need_concat, (rs + " " + sn).str.strip())
-            
-            empty_rs = (rs == "")
-            rs = rs.where(~empty_rs, (pn + " " + sn).str.strip())
-            rs = rs.map(lambda x: x if x.strip() else "NÃO INFORMADO")
-            
-            mapped_data['razao_social'] = rs
-            
-            output_df = pd.DataFrame({
-                col: mapped_data.get(col.lower(), [""] * len(df))
-                for col in TARGET_COLUMNS
-            })
-            
-            output_df['uf'] = output_df['uf'].astype(str).str.strip().str.upper().str[:2]
-            
-            output_df = output_df.drop_duplicates(subset=['cpf'], keep='first').reset_index(drop=True)
-            
-            return output_df
-            
-        except Exception as e:
-            st.error(f"ERRO NO PROCESSAMENTO: {str(e)}")
-            return None
+    # O resultado fica em cache pelo conteúdo do arquivo, então os reruns
+    # do Streamlit (ex.: clique no download) não reprocessam tudo
+    try:
+        with st.spinner("Processando arquivo..."):
+            return _process_bytes(file.name, file.getvalue())
+    except ValueError as e:
+        st.error(str(e))
+        return None
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def to_xlsx_bytes(df: pd.DataFrame) -> bytes:
+    # xlsxwriter é bem mais rápido que o openpyxl para gerar a planilha.
+    # constant_memory não é usado: o pandas grava coluna a coluna e esse modo
+    # descarta células de linhas já finalizadas. Textos são gravados como
+    # texto, sem virar fórmula ("=...") nem hyperlink.
+    output = BytesIO()
+    options = {'strings_to_formulas': False, 'strings_to_urls': False}
+    with pd.ExcelWriter(output, engine='xlsxwriter', engine_kwargs={'options': options}) as writer:
+        df.to_excel(writer, index=False)
+    return output.getvalue()
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def to_csv_bytes(df: pd.DataFrame) -> bytes:
+    output = BytesIO()
+    df.to_csv(output, index=False, encoding='utf-8-sig')
+    return output.getvalue()
 
 # ========== UI COMPONENTS ==========
 def main():
@@ -154,6 +258,7 @@ def main():
         help="Arquivos CSV devem conter cabeçalhos na primeira linha"
     )
     
+    result = None
     if uploaded_file:
         result = process_data(uploaded_file)
         
@@ -162,33 +267,40 @@ def main():
             st.subheader("Pré-visualização dos dados")
             st.dataframe(result.head())
             
-            output = BytesIO()
-            result.to_excel(output, index=False)
-            output.seek(0)
-            
+            # Os arquivos só são gerados quando o usuário clica em baixar
             st.download_button(
                 label="⬇️ Baixar Planilha Formatada",
-                data=output,
+                data=lambda: to_xlsx_bytes(result),
                 file_name="dados_pessoais_formatados.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                on_click="ignore"
+            )
+            st.download_button(
+                label="⬇️ Baixar CSV",
+                data=lambda: to_csv_bytes(result),
+                file_name="dados_pessoais_formatados.csv",
+                mime="text/csv",
+                on_click="ignore"
             )
     
-    with st.expander("ℹ️ Precisa de ajuda?"):
-        st.markdown("""
-        **Soluções para problemas comuns:**
-        
-        1. **Erro ao ler arquivo CSV**:
-           - Verifique se o arquivo usa vírgulas como separador
-           - Campos com quebras de linha devem estar entre aspas
-           - Tente salvar como Excel (.xlsx) se persistir
-        
-        2. **Colunas não reconhecidas**:
-           - Certifique-se que seu arquivo contém cabeçalhos
-           - Nomes alternativos para CPF/CNPJ: 'documento', 'cpf/cnpj'
-        
-        3. **Dados faltantes**:
-           - Campos não encontrados serão preenchidos com vazio
-        """)
+    # A ajuda só é montada enquanto não há resultado (sem arquivo ou com erro)
+    if result is None:
+        with st.expander("ℹ️ Precisa de ajuda?"):
+            st.markdown("""
+            **Soluções para problemas comuns:**
+            
+            1. **Erro ao ler arquivo CSV**:
+               - Verifique se o arquivo usa vírgulas como separador
+               - Campos com quebras de linha devem estar entre aspas
+               - Tente salvar como Excel (.xlsx) se persistir
+            
+            2. **Colunas não reconhecidas**:
+               - Certifique-se que seu arquivo contém cabeçalhos
+               - Nomes alternativos para CPF/CNPJ: 'documento', 'cpf/cnpj'
+            
+            3. **Dados faltantes**:
+               - Campos não encontrados serão preenchidos com vazio
+            """)
 
 if __name__ == "__main__":
     main()